@@ -0,0 +1,109 @@
+# Copyright (C) 2023 Alexandre Jesus <https://adbjesus.com>, Carlos M. Fonseca <cmfonsec@dei.uc.pt>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Compiled inner loops of the problem modules. They live in an imported
+# module rather than in the scripts: numba's on-disk cache keeps the
+# globals of the defining module alive, which for a __main__ script
+# keeps its output file from being flushed at exit.
+
+from __future__ import annotations
+
+from math import isclose
+
+import numpy as np
+
+from api.utils import njit, HAVE_NUMBA
+
+@njit(cache=True)
+def best_2opt(path, dist):
+    "Best improving 2-opt move (i, j, delta), or (-1, -1, 0.0) if none"
+    best_i, best_j, best_delta = -1, -1, 0.0
+    n = path.shape[0]
+    for i in range(1, n):
+        a, b = path[i-1], path[i]
+        dab = dist[a, b]
+        for j in range(i+2, n):
+            c, d = path[j-1], path[j]
+            delta = dist[a, c] + dist[b, d] - dab - dist[c, d]
+            # same tolerances as api.utils.isclose
+            tol = max(1e-6 * max(abs(delta), abs(best_delta)), 1e-9)
+            if delta < best_delta and abs(delta - best_delta) > tol:
+                best_i, best_j, best_delta = i, j, delta
+    return best_i, best_j, best_delta
+
+def best_2opt_vectorized(path, dist):
+    "NumPy counterpart of best_2opt, evaluating all moves at once"
+    a, b = path[:-1], path[1:]
+    m = len(a)
+    if m < 3:
+        return -1, -1, 0.0
+    # delta[i-1, j-1] for the move (i, j)
+    e = dist[a, b]
+    delta = dist[a[:, None], a] + dist[b[:, None], b] - e[:, None] - e
+    delta[np.tril_indices(m, k=1)] = np.inf
+    k = int(delta.argmin())
+    best_delta = float(delta.flat[k])
+    if best_delta < 0 and not isclose(best_delta, 0, rel_tol=1e-6, abs_tol=1e-9):
+        return k // m + 1, k % m + 1, best_delta
+    return -1, -1, 0.0
+
+if not HAVE_NUMBA:
+    # an interpreted double loop is much slower than the O(n^2) arrays
+    best_2opt = best_2opt_vectorized
+
+@njit(cache=True)
+def minimal_connections(idx, c2c_min, c2p_min):
+    "Sum of the cheapest arrivals at the containers idx, plus the cheapest route to the plant"
+    m = idx.shape[0]
+    if m == 0:
+        # numba does not bounds-check idx[0] below
+        raise ValueError("minimal_connections requires at least one container")
+    obj_value = 0
+    # cheapest arrival at each container from any other one, in any direction
+    for a in range(m):
+        best = c2c_min[idx[a], idx[a]]
+        found = False
+        for b in range(m):
+            if b != a:
+                v = c2c_min[idx[b], idx[a]]
+                if not found or v < best:
+                    best = v
+                    found = True
+        if found:
+            obj_value += best
+
+    # add the route from the last container to the plant
+    best = c2p_min[idx[0]]
+    for a in range(1, m):
+        if c2p_min[idx[a]] < best:
+            best = c2p_min[idx[a]]
+    return obj_value + best
+
+def minimal_connections_vectorized(idx, c2c_min, c2p_min):
+    "NumPy counterpart of minimal_connections"
+    if len(idx) == 0:
+        raise ValueError("minimal_connections requires at least one container")
+    obj_value = np.int64(0)
+    if len(idx) > 1:
+        sub = c2c_min[np.ix_(idx, idx)]
+        # any off-diagonal entry is <= the maximum, so this masks the diagonal
+        # for both integer and floating point costs
+        np.fill_diagonal(sub, sub.max())
+        obj_value += sub.min(axis=0).sum(dtype=np.promote_types(sub.dtype, np.int64))
+
+    return obj_value + c2p_min[idx].min()
+
+if not HAVE_NUMBA:
+    minimal_connections = minimal_connections_vectorized
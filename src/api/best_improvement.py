@@ -37,16 +37,24 @@ Solution = TypeVar('Solution', bound=SolutionProtocol)
 
 def best_improvement(solution: Solution, budget: float) -> Solution:
     start = perf_counter()
+    # Solutions may provide a (compiled) full sweep returning the best
+    # improving move and its increment, or None at a local optimum
+    best_local_move = getattr(solution, 'best_local_move', None)
     while perf_counter() - start < budget:
         best_incr: ObjectiveBound = 0
         best_move = None
-        for move in solution.local_moves():
-            delta = cast(ObjectiveBound, solution.objective_incr_local(move))
-            if delta < best_incr and not isclose(delta, best_incr):
-                best_incr = delta
-                best_move = move
-            if perf_counter() - start >= budget:
-                break
+        if best_local_move is not None:
+            best = best_local_move()
+            if best is not None:
+                best_move, best_incr = best
+        else:
+            for move in solution.local_moves():
+                delta = cast(ObjectiveBound, solution.objective_incr_local(move))
+                if delta < best_incr and not isclose(delta, best_incr):
+                    best_incr = delta
+                    best_move = move
+                if perf_counter() - start >= budget:
+                    break
         if best_move is not None:
             logging.debug(f"Improvement found: {best_incr}")
             solution.step(best_move)
@@ -24,6 +24,17 @@ from math import ceil, log2
 import math
 import random
 
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    # numba is optional: without it kernels run as plain Python
+    HAVE_NUMBA = False
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda f: f
+
 T = TypeVar('T')
 
 def argmax(v: Iterable[T]) -> int:
@@ -17,19 +17,23 @@
 
 from __future__ import annotations
 
-from copy import copy
-from typing import TextIO, Optional, Any
+from typing import TextIO, Optional, Tuple, Any
 from collections.abc import Iterable, Hashable
 from dataclasses import dataclass
 import logging
-import random
+import os
+import zipfile
 import numpy as np
 
+from api.utils import sample
+from _kernels import minimal_connections
+
 Objective = Any
 
 
 @dataclass
 class Component:
+    __slots__ = ('node', 'direction')
     node: int
     direction: int
 
@@ -38,36 +42,37 @@ class Component:
         return self.node, self.direction
 
 
-@dataclass
-class LocalMove:
-    i: int
-    j: int
-    i_dir: int
-    j_dir: int
+# (i, j, i_dir, j_dir): swap the containers at positions i and j and
+# set their directions to i_dir and j_dir respectively
+LocalMove = Tuple[int, int, int, int]
 
 
 class Solution:
+    __slots__ = ('problem', 'containers', 'directions', 'plen', 'picked', 'obj_value', '_lb_cache')
+
     def __init__(self,
                  problem: Problem,
-                 containers: list,
-                 directions: list,
-                 picked: set,
-                 not_picked: set,
+                 containers: np.ndarray,
+                 directions: np.ndarray,
+                 plen: int,
+                 picked: np.ndarray,
                  obj_value: float) -> None:
         self.problem = problem
-        self.containers = containers  # list of all containers between depot and treatment plant
-        self.directions = directions  # list of directions proportionate to the containers
-        self.picked = picked  # list of all picked containers
-        self.not_picked = not_picked  # list of all not yet picked containers
+        self.containers = containers  # containers between depot and treatment plant (first plen in use)
+        self.directions = directions  # directions of the containers (first plen in use)
+        self.plen = plen  # number of picked containers
+        self.picked = picked  # mask of all picked containers
         self.obj_value = obj_value
+        self._lb_cache: Optional[Objective] = None  # lower bound, reset by add and step
 
     def output(self) -> str:
         """
         Generate the output string for this solution
         """
         str = ""
-        for i in range(len(self.containers)):
-            str += f"{self.containers[i] + 1} {self.directions[i]}\n"
+        for container, direction in zip(self.containers[:self.plen].tolist(),
+                                        self.directions[:self.plen].tolist()):
+            str += f"{container + 1} {direction}\n"
 
         return str.rstrip()
 
@@ -78,23 +83,24 @@ class Solution:
         Note: changes to the copy must not affect the original
         solution. However, this does not need to be a deepcopy.
         """
-        return self.__class__(
+        solution = self.__class__(
             self.problem,
-            copy(self.containers),
-            copy(self.directions),
-            copy(self.picked),
-            copy(self.not_picked),
+            self.containers.copy(),
+            self.directions.copy(),
+            self.plen,
+            self.picked.copy(),
             self.obj_value
         )
+        solution._lb_cache = self._lb_cache
+        return solution
 
     def is_feasible(self) -> bool:
         """
         Return whether the solution is feasible or not
         """
-        # Constraint 1: check if all containers are included in the solution (or picked)
-        unique_containers = list(set(self.containers))  # remove duplicates
-
-        if len(unique_containers) != self.problem.n:
+        # Constraint 1: check if all containers are included in the solution (or picked),
+        # containers are unique since only not yet picked ones can be added
+        if self.plen != self.problem.n:
             return False
         else:
             # check other constraints
@@ -106,57 +112,38 @@ class Solution:
         should return None
         """
         # case the solution is not completed
-        if len(self.not_picked) > 0:
+        if self.plen < self.problem.n:
             return None
 
         # add route from last container to plant and return
-        return self.obj_value + self.problem.container_to_plant[self.directions[-1]][self.containers[-1]]
+        last = self.plen - 1
+        return self.obj_value + self.problem.container_to_plant[self.directions[last], self.containers[last]]
 
     def lower_bound(self) -> Optional[Objective]:
         """
         Return the lower bound value for this solution if defined,
         otherwise return None
         """
-        if len(self.not_picked) == 0:
+        if self.plen == self.problem.n:
             return None
 
-        # current obj_value
-        obj_value = self.obj_value
-
-        # add the minimal amount of connections to be made (including the plant)
-        obj_value += self.get_minimal_connections(self.not_picked)
-
-        return obj_value
+        if self._lb_cache is None:
+            # current obj_value plus the minimal amount of connections to be
+            # made (including the plant)
+            self._lb_cache = self.obj_value + self.get_minimal_connections(np.flatnonzero(~self.picked))
 
-    def get_minimal_connections(self, containers) -> int:
-        obj_value = 0
+        return self._lb_cache
 
-        for dest_con in containers:
-            options = []
-            for dep_con in containers:
-                for dir_idx in range(4):
-                    if dep_con != dest_con:
-                        options.append(self.problem.container_to_container[dir_idx][dep_con][dest_con])
-
-            # add the minimum value
-            if len(options) > 0:
-                obj_value += min(options)
-
-        # add the route from the last container to the plant
-        options = []
-        for dep_con in containers:
-            for dir_idx in range(2):
-                options.append(self.problem.container_to_plant[dir_idx][dep_con])
-        obj_value += min(options)
-
-        return obj_value
+    def get_minimal_connections(self, idx: np.ndarray) -> int:
+        # idx: indices of the containers still to be connected
+        return minimal_connections(idx, self.problem.c2c_min, self.problem.c2p_min)
 
     def add_moves(self) -> Iterable[Component]:
         """
         Return an iterable (generator, iterator, or iterable object)
         over all components that can be added to the solution
         """
-        for container in self.not_picked:
+        for container in np.flatnonzero(~self.picked).tolist():
             for direction in range(2):
                 yield Component(container, direction)
 
@@ -167,15 +154,9 @@ class Solution:
         """
         for idx_1 in range(self.problem.n):
             for idx_2 in range(idx_1, self.problem.n):
-                for dir_idx in range(4):
-                    if dir_idx == 0:
-                        yield LocalMove(idx_1, idx_2, 0, 0)
-                    elif dir_idx == 1:
-                        yield LocalMove(idx_1, idx_2, 0, 1)
-                    elif dir_idx == 2:
-                        yield LocalMove(idx_1, idx_2, 1, 0)
-                    else:
-                        yield LocalMove(idx_1, idx_2, 1, 1)
+                for i_dir in range(2):
+                    for j_dir in range(2):
+                        yield (idx_1, idx_2, i_dir, j_dir)
 
     def random_local_move(self) -> Optional[LocalMove]:
         """
@@ -193,54 +174,33 @@ class Solution:
         over all local moves (in random order) that can be applied to
         the solution.
         """
-        range_1 = list(range(self.problem.n))
-        random.shuffle(range_1)
-        for idx_1 in range_1:
-            range_2 = list(range(idx_1, self.problem.n))
-            random.shuffle(range_2)
-            for idx_2 in range_2:
-                range_dir = list(range(4))
-                random.shuffle(range_dir)
-                for dir_idx in range_dir:
-                    if dir_idx == 0:
-                        yield LocalMove(idx_1, idx_2, 0, 0)
-                    elif dir_idx == 1:
-                        yield LocalMove(idx_1, idx_2, 0, 1)
-                    elif dir_idx == 2:
-                        yield LocalMove(idx_1, idx_2, 1, 0)
-                    else:
-                        yield LocalMove(idx_1, idx_2, 1, 1)
+        idx_1, idx_2 = self.problem.local_move_pairs
+        # lazily, so that random_local_move and callers taking only a few
+        # moves stay O(1)
+        for k in sample(4 * len(idx_1)):
+            pair, dir_idx = divmod(k, 4)
+            yield (idx_1.item(pair), idx_2.item(pair), dir_idx >> 1, dir_idx & 1)
 
     def heuristic_add_move(self) -> Optional[Component]:
         """
         Return the next component to be added based on some heuristic
         rule.
         """
-        if len(self.not_picked) == 0:
+        if self.plen == self.problem.n:
             return None
 
-        candidates = []
-        if len(self.containers) == 0:
-            candidates.append(self.problem.depot_to_container[0])
-            candidates.append(self.problem.depot_to_container[1])
+        # (2, n) cost of reaching each container in each direction
+        if self.plen == 0:
+            candidates = self.problem.depot_to_container
         else:
-            dir_idx_0 = int(str(self.directions[-1]) + str(0), 2)
-            dir_idx_1 = int(str(self.directions[-1]) + str(1), 2)
-            candidates.append(self.problem.container_to_container[dir_idx_0][self.containers[-1]])
-            candidates.append(self.problem.container_to_container[dir_idx_1][self.containers[-1]])
-
-        best_candidate = {"val": max(candidates[0] + candidates[1]), "idx": None, "direction": None}
-        for idx in self.not_picked:
-            if candidates[0][idx] < best_candidate["val"]:
-                best_candidate["val"] = candidates[0][idx]
-                best_candidate["idx"] = idx
-                best_candidate["direction"] = 0
-            if candidates[1][idx] < best_candidate["val"]:
-                best_candidate["val"] = candidates[1][idx]
-                best_candidate["idx"] = idx
-                best_candidate["direction"] = 1
-
-        return Component(best_candidate["idx"], best_candidate["direction"])
+            last = self.plen - 1
+            candidates = self.problem.c2c_by_dir[self.directions[last], :, self.containers[last]]
+
+        # (n, 2) layout so ties go to the lowest container, then direction 0
+        costs = np.where(self.picked[:, None], np.inf, candidates.T)
+        node, direction = divmod(int(costs.argmin()), 2)
+
+        return Component(node, direction)
 
     def add(self, component: Component) -> None:
         """
@@ -249,26 +209,31 @@ class Solution:
         Note: this invalidates any previously generated components and
         local moves.
         """
-        if len(self.containers) == 0:
+        if self.plen == 0:
             self.obj_value += self.problem.depot_to_container[component.direction][component.node]
         else:
-            self.obj_value += self.connection_cost(Component(self.containers[-1], self.directions[-1]), component)
+            self.obj_value += self.connection_cost(self.last_component(), component)
+
+        self.containers[self.plen] = component.node
+        self.directions[self.plen] = component.direction
+        self.plen += 1
 
-        self.containers.append(component.node)
-        self.directions.append(component.direction)
+        self.picked[component.node] = True
+        self._lb_cache = None
 
-        self.picked.add(component.node)
-        self.not_picked.remove(component.node)
+    def last_component(self) -> Component:
+        last = self.plen - 1
+        return Component(int(self.containers[last]), int(self.directions[last]))
 
     def connection_cost(self, last_component, new_component):
+        problem = self.problem
         if last_component.node == -1:
-            return self.problem.depot_to_container[new_component.direction][new_component.node]
-        if new_component.node == self.problem.n:
-            return self.problem.container_to_plant[last_component.direction][last_component.node]
+            return problem.depot_to_container[new_component.direction, new_component.node]
+        if new_component.node == problem.n:
+            return problem.container_to_plant[last_component.direction, last_component.node]
 
-        # construct the direction index by concat the directions to a binary string a read it in dec
-        dir_idx = int(str(last_component.direction) + str(new_component.direction), 2)
-        return self.problem.container_to_container[dir_idx][last_component.node][new_component.node]
+        return problem.c2c_by_dir[last_component.direction, new_component.direction,
+                                  last_component.node, new_component.node]
 
     def step(self, lmove: LocalMove) -> None:
         """
@@ -277,12 +242,14 @@ class Solution:
         Note: this invalidates any previously generated components and
         local moves.
         """
-        tmp = self.containers[lmove.i]
-        self.containers[lmove.i] = self.containers[lmove.j]
-        self.containers[lmove.j] = tmp
+        i, j, i_dir, j_dir = lmove
+        tmp = self.containers[i]
+        self.containers[i] = self.containers[j]
+        self.containers[j] = tmp
 
-        self.directions[lmove.i] = lmove.i_dir
-        self.directions[lmove.j] = lmove.j_dir
+        self.directions[i] = i_dir
+        self.directions[j] = j_dir
+        self._lb_cache = None
 
     def objective_incr_local(self, lmove: LocalMove) -> Optional[Objective]:
         """
@@ -290,31 +257,38 @@ class Solution:
         local move. If the objective value is not defined after
         applying the local move return None.
         """
-        pc_1 = self.containers[lmove.i - 1] if lmove.i > 0 else -1
-        pd_1 = self.directions[lmove.i - 1] if lmove.i > 0 else None
-        cc_1 = self.containers[lmove.i]
-        cd_1 = self.directions[lmove.i]
-        fc_1 = self.containers[lmove.i + 1] if lmove.i < self.problem.n - 1 else self.problem.n
-        fd_1 = self.directions[lmove.i + 1] if lmove.i < self.problem.n - 1 else None
-
-        pc_2 = self.containers[lmove.j - 1] if lmove.j > 0 else -1
-        pd_2 = self.directions[lmove.j - 1] if lmove.j > 0 else None
-        cc_2 = self.containers[lmove.j]
-        cd_2 = self.directions[lmove.j]
-        fc_2 = self.containers[lmove.j + 1] if lmove.j < self.problem.n - 1 else self.problem.n
-        fd_2 = self.directions[lmove.j + 1] if lmove.j < self.problem.n - 1 else None
-
-        obj_value_old = 0
-        obj_value_old += self.connection_cost(Component(pc_1, pd_1), Component(cc_1, cd_1))
-        obj_value_old += self.connection_cost(Component(cc_1, cd_1), Component(fc_1, fd_1))
-        obj_value_old += self.connection_cost(Component(pc_2, pd_2), Component(cc_2, cd_2))
-        obj_value_old += self.connection_cost(Component(cc_2, cd_2), Component(fc_2, fd_2))
-
-        obj_value_new = 0
-        obj_value_new += self.connection_cost(Component(pc_1, pd_1), Component(cc_2, lmove.j_dir))
-        obj_value_new += self.connection_cost(Component(cc_2, lmove.j_dir), Component(fc_1, fd_1))
-        obj_value_new += self.connection_cost(Component(pc_2, pd_2), Component(cc_1, lmove.i_dir))
-        obj_value_new += self.connection_cost(Component(cc_1, lmove.i_dir), Component(fc_2, fd_2))
+        i, j, i_dir, j_dir = lmove
+        containers, directions = self.containers, self.directions
+        n = self.problem.n
+        cost = self.connection_cost
+
+        # .item() gives Python ints, which index the cost arrays faster than NumPy scalars
+        pc_1 = containers.item(i - 1) if i > 0 else -1
+        pd_1 = directions.item(i - 1) if i > 0 else None
+        cc_1 = containers.item(i)
+        cd_1 = directions.item(i)
+        fc_1 = containers.item(i + 1) if i < n - 1 else n
+        fd_1 = directions.item(i + 1) if i < n - 1 else None
+
+        pc_2 = containers.item(j - 1) if j > 0 else -1
+        pd_2 = directions.item(j - 1) if j > 0 else None
+        cc_2 = containers.item(j)
+        cd_2 = directions.item(j)
+        fc_2 = containers.item(j + 1) if j < n - 1 else n
+        fd_2 = directions.item(j + 1) if j < n - 1 else None
+
+        # accumulate in int64: the int32 costs could overflow when summed
+        obj_value_old = np.int64(0)
+        obj_value_old += cost(Component(pc_1, pd_1), Component(cc_1, cd_1))
+        obj_value_old += cost(Component(cc_1, cd_1), Component(fc_1, fd_1))
+        obj_value_old += cost(Component(pc_2, pd_2), Component(cc_2, cd_2))
+        obj_value_old += cost(Component(cc_2, cd_2), Component(fc_2, fd_2))
+
+        obj_value_new = np.int64(0)
+        obj_value_new += cost(Component(pc_1, pd_1), Component(cc_2, j_dir))
+        obj_value_new += cost(Component(cc_2, j_dir), Component(fc_1, fd_1))
+        obj_value_new += cost(Component(pc_2, pd_2), Component(cc_1, i_dir))
+        obj_value_new += cost(Component(cc_1, i_dir), Component(fc_2, fd_2))
 
         return obj_value_new - obj_value_old
 
@@ -324,18 +298,17 @@ class Solution:
         component. If the lower bound is not defined after adding the
         component return None.
         """
-        if len(self.not_picked) == 1:
+        if self.plen == self.problem.n - 1:
             return 0
 
-        if len(self.containers) == 0:
+        if self.plen == 0:
             new_obj_value = self.problem.depot_to_container[component.direction][component.node]
         else:
-            new_obj_value = self.obj_value + self.connection_cost(
-                Component(self.containers[-1], self.directions[-1]), component)
+            new_obj_value = self.obj_value + self.connection_cost(self.last_component(), component)
 
-        self.not_picked.remove(component.node)
-        new_obj_value += self.get_minimal_connections(self.not_picked)
-        self.not_picked.add(component.node)
+        not_picked = ~self.picked
+        not_picked[component.node] = False
+        new_obj_value += self.get_minimal_connections(np.flatnonzero(not_picked))
 
         return new_obj_value - self.lower_bound()
 
@@ -351,55 +324,121 @@ class Solution:
         """
         Returns an iterable to the components of a solution
         """
-        for idx in range(self.problem.n):
-            yield Component(self.containers[idx], self.directions[idx])
+        for container, direction in zip(self.containers[:self.plen].tolist(),
+                                        self.directions[:self.plen].tolist()):
+            yield Component(container, direction)
 
 
 class Problem:
+    # bump whenever the layout of the cached arrays changes
+    _CACHE_VERSION = 1
+
     def __init__(self, n: int, depot_to_container: np.ndarray, container_to_plant: np.ndarray,
                  container_to_container: np.ndarray) -> None:
         self.n = n
         self.depot_to_container = depot_to_container
         self.container_to_plant = container_to_plant
-        # index - combination: 0 - 00, 1 - 10, 2 - 11, 3 - 10
+        # index - combination: 0 - 00, 1 - 01, 2 - 10, 3 - 11 (c2c_by_dir relies on this order)
         self.container_to_container = container_to_container
+        # the same costs indexed by [departure direction, arrival direction]
+        self.c2c_by_dir = container_to_container.reshape(2, 2, n, n)
+        # cheapest connections over all directions, used by the lower bound
+        self.c2c_min = container_to_container.min(axis=0)
+        self.c2p_min = container_to_plant.min(axis=0)
+        # all position pairs (i, j), i <= j, for local moves
+        self.local_move_pairs = np.triu_indices(n)
 
     @classmethod
     def from_textio(cls, f: TextIO) -> Problem:
         """
         Create a problem from a text I/O source `f`
+
+        If `f` is a file on disk the parsed costs are cached next to it
+        (as `<name>.npz`) and reused as long as the file is not modified.
         """
+        cache = cls._cache_path(f)
+        if cache is not None:
+            # identifies the exact text file the cache was built from
+            st = os.stat(f.name)
+            source = np.array([st.st_mtime_ns, st.st_size], dtype=np.int64)
+            problem = cls._load_cache(cache, source)
+            if problem is not None:
+                return problem
+
         n = int(f.readline())
 
-        depot_to_container = np.empty([2, n])
-        container_to_plant = np.empty([2, n])
+        # 4 rows of depot/plant costs followed by four n x n blocks
+        arr = np.loadtxt(f, dtype=np.int64, max_rows=4 + 4 * n, ndmin=2)
+        if arr.shape != (4 + 4 * n, n):
+            raise ValueError(f"Expected {4 + 4 * n} rows of {n} values, got shape {arr.shape}")
+        # costs are integral: store them as int32 where they fit to halve
+        # the memory traffic of the lower bound and move evaluations
+        if arr.size > 0 and np.iinfo(np.int32).min <= arr.min() and arr.max() <= np.iinfo(np.int32).max:
+            arr = arr.astype(np.int32)
+
+        depot_to_container = arr[0:2]
+        container_to_plant = arr[2:4]
         # index - combination: 0 - 00, 1 - 01, 2 - 10, 3 - 11
-        container_to_container = np.empty([4, n, n])
-
-        for idx in range(1, 5 + 4 * n):
-            line = f.readline().strip()  # Remove leading/trailing whitespaces
-            elements = [int(x) for x in line.split()]  # Split line by spaces
-            if idx == 1:
-                depot_to_container[0] = elements
-            elif idx == 2:
-                depot_to_container[1] = elements
-            elif idx == 3:
-                container_to_plant[0] = elements
-            elif idx == 4:
-                container_to_plant[1] = elements
-            elif idx < n + 5:
-                container_to_container[0][idx - 5] = elements
-            elif idx < 2 * n + 5:
-                container_to_container[1][idx - n - 5] = elements
-            elif idx < 3 * n + 5:
-                container_to_container[3][idx - 2 * n - 5] = elements
-            else:
-                container_to_container[2][idx - 3 * n - 5] = elements
+        # (the blocks are stored in the order 00, 01, 11, 10)
+        container_to_container = arr[4:].reshape(4, n, n)[[0, 1, 3, 2]]
+
+        if cache is not None:
+            # write to a temporary file first so that readers never see a partial cache
+            tmp = f"{cache}.{os.getpid()}.tmp"
+            try:
+                with open(tmp, 'wb') as out:
+                    np.savez(out, version=cls._CACHE_VERSION, source=source,
+                             n=n, depot_to_container=depot_to_container,
+                             container_to_plant=container_to_plant,
+                             container_to_container=container_to_container)
+                os.replace(tmp, cache)
+            except OSError as e:
+                logging.debug(f"Could not write problem cache {cache}: {e}")
+                if os.path.exists(tmp):
+                    os.remove(tmp)
 
         return cls(n, depot_to_container, container_to_plant, container_to_container)
 
+    @classmethod
+    def _load_cache(cls, cache: str, source: np.ndarray) -> Optional[Problem]:
+        """
+        Load a problem cached by from_textio, or return None if the cache is
+        missing, unreadable, from another format version or another source
+        """
+        try:
+            with np.load(cache) as data:
+                if int(data['version']) != cls._CACHE_VERSION:
+                    return None
+                if not np.array_equal(data['source'], source):
+                    return None
+                n = int(data['n'])
+                depot_to_container = data['depot_to_container']
+                container_to_plant = data['container_to_plant']
+                container_to_container = data['container_to_container']
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return None
+
+        if (depot_to_container.shape != (2, n) or container_to_plant.shape != (2, n)
+                or container_to_container.shape != (4, n, n)):
+            return None
+
+        return cls(n, depot_to_container, container_to_plant, container_to_container)
+
+    @staticmethod
+    def _cache_path(f: TextIO) -> Optional[str]:
+        name = getattr(f, 'name', None)
+        if isinstance(name, str) and os.path.isfile(name):
+            return name + '.npz'
+        return None
+
     def empty_solution(self) -> Solution:
-        return Solution(self, [], [], set([]), set(range(self.n)), 0)
+        # accumulate in int64 regardless of the storage type of the costs
+        return Solution(self,
+                        np.empty(self.n, dtype=np.int32),
+                        np.empty(self.n, dtype=np.int8),
+                        0,
+                        np.zeros(self.n, dtype=np.bool_),
+                        np.int64(0))
 
 
 if __name__ == '__main__':
@@ -17,21 +17,28 @@
 
 from __future__ import annotations
 
-from typing import TextIO, Optional, cast, NewType
+from typing import TextIO, Optional, Tuple, cast, NewType
 from collections.abc import Sequence, Iterable, Hashable
 
 from dataclasses import dataclass
-from math import sqrt, isclose
-from copy import copy
+from math import isclose
 from itertools import chain
 import random
 import logging
 import sys
 
-from api.utils import or_default, pairwise, sample2
+import numpy as np
+
+from api.utils import or_default, sample
+from _kernels import best_2opt
+
+# Recompute the tour length after every step (set to False to skip the
+# O(n) check without having to run python with -O)
+_DEEP_CHECKS = __debug__
 
 @dataclass
 class Component:
+    __slots__ = ('u', 'v')
     u: int
     v: int
 
@@ -39,51 +46,50 @@ class Component:
     def cid(self) -> Hashable:
         return self.u, self.v
 
-@dataclass
-class LocalMove:
-    i: int
-    j: int
+# 2-opt move (i, j): reverse path[i:j]. Local moves are generated in
+# bulk by the local searches, so they are plain tuples
+LocalMove = Tuple[int, int]
 
-if sys.version_info < (3, 9):
-    Path = NewType('Path', list)
-    Used = NewType('Used', set)
-    Unused = NewType('Unused', set)
-else:
-    Path = NewType('Path', list[int])
-    Used = NewType('Used', set[int])
-    Unused = NewType('Unused', set[int])
+# Path holds nnodes+1 preallocated node indices, of which the first
+# plen are in use; Used is a boolean bitmap over the nodes
+Path = NewType('Path', np.ndarray)
+Used = NewType('Used', np.ndarray)
 
 class Solution():
+    __slots__ = ('problem', 'start', 'path', 'plen', 'used', 'dist', '_next')
+
     def __init__(self,
                  problem: Problem,
                  start: int,
                  path: Path,
+                 plen: int,
                  used: Used,
-                 unused: Unused,
                  dist: float) -> None:
         self.problem = problem
         self.start = start
         self.path = path
+        self.plen = plen
         self.used = used
-        self.unused = unused
         self.dist = dist
+        # (u, v, dist[u, v]) of the edge last suggested by heuristic_add_move
+        self._next: Optional[tuple[int, int, float]] = None
 
     def output(self) -> str:
-        return "\n".join(map(str, self.path))
+        return "\n".join(map(str, self.path[:self.plen].tolist()))
 
     def copy(self):
         return self.__class__(self.problem,
                               self.start,
-                              copy(self.path),
-                              copy(self.used),
-                              copy(self.unused),
+                              self.path.copy(),
+                              self.plen,
+                              self.used.copy(),
                               self.dist)
 
     def is_feasible(self) -> bool:
-        return len(self.path) == self.problem.nnodes + 1
+        return self.plen == self.problem.nnodes + 1
 
     def objective(self) -> Optional[float]:
-        if len(self.path) == self.problem.nnodes + 1:
+        if self.plen == self.problem.nnodes + 1:
             return self.dist
         else:
             return None
@@ -92,85 +98,91 @@ class Solution():
         return self.dist
 
     def add_moves(self) -> Iterable[Component]:
-        if len(self.path) < self.problem.nnodes:
-            u = self.path[-1]
-            for v in self.unused:
+        if self.plen < self.problem.nnodes:
+            u = int(self.path[self.plen-1])
+            for v in np.flatnonzero(~self.used).tolist():
                 yield Component(u, v)
-        elif len(self.path) == self.problem.nnodes:
-            u = self.path[-1]
+        elif self.plen == self.problem.nnodes:
+            u = int(self.path[self.plen-1])
             yield Component(u, self.start)
 
     def local_moves(self) -> Iterable[LocalMove]:
-        for i in range(1, len(self.path)):
-            for j in range(i+2, len(self.path)):
-                yield LocalMove(i, j)
+        for i in range(1, self.plen):
+            for j in range(i+2, self.plen):
+                yield (i, j)
+
+    def best_local_move(self) -> Optional[tuple[LocalMove, float]]:
+        i, j, delta = best_2opt(self.path[:self.plen], self.problem.dist)
+        if i < 0:
+            return None
+        return (int(i), int(j)), float(delta)
 
     def random_local_move(self) -> Optional[LocalMove]:
-        if len(self.path) >= 4:
-            i = random.randrange(1, len(self.path)-2)
-            j = random.randrange(i+2, len(self.path))
-            return LocalMove(i, j)
+        if self.plen >= 4:
+            i = random.randrange(1, self.plen-2)
+            j = random.randrange(i+2, self.plen)
+            return (i, j)
         else:
             return None
 
     def random_local_moves_wor(self) -> Iterable[LocalMove]:
-        for i, j in sample2(len(self.path), len(self.path)):
-            if i >= 1 and j >= i+2:
-                yield LocalMove(i, j)
+        # lazily, so that callers taking only a few moves stay O(1)
+        ii, jj = self.problem.local_move_pairs(self.plen)
+        for k in sample(len(ii)):
+            yield (ii.item(k), jj.item(k))
 
     def heuristic_add_move(self) -> Optional[Component]:
         # Return the closest
-        if len(self.path) < self.problem.nnodes:
-            best = None
-            bestd = None
-            u = self.path[-1]
-            for v in self.unused:
-                d = self.problem.dist[u][v] 
-                if bestd is None or d < bestd:
-                    best = Component(u, v)
-                    bestd = d
-            return best
-        elif len(self.path) == self.problem.nnodes:
-            u = self.path[-1]
+        if self.plen < self.problem.nnodes:
+            u = int(self.path[self.plen-1])
+            row = np.where(self.used, np.inf, self.problem.dist[u])
+            v = int(row.argmin())
+            self._next = (u, v, row[v])
+            return Component(u, v)
+        elif self.plen == self.problem.nnodes:
+            u = int(self.path[self.plen-1])
             return Component(u, self.start)
         return None
 
     def add(self, component: Component) -> None:
         u, v = component.u, component.v
-        self.path.append(v)
-        if v != self.start:
-            self.unused.remove(v)
-        self.used.add(v)
-        self.dist += self.problem.dist[u][v]
+        self.path[self.plen] = v
+        self.plen += 1
+        self.used[v] = True
+        nxt, self._next = self._next, None
+        if nxt is not None and nxt[0] == u and nxt[1] == v:
+            self.dist += nxt[2]
+        else:
+            self.dist += self.problem.dist[u, v]
 
     def step(self, lmove: LocalMove) -> None:
-        i, j = lmove.i, lmove.j
-        self.dist -= self.problem.dist[self.path[i-1]][self.path[i]]
-        self.dist -= self.problem.dist[self.path[j-1]][self.path[j]]
-        self.path[i:j] = list(reversed(self.path[i:j]))
-        self.dist += self.problem.dist[self.path[i-1]][self.path[i]]
-        self.dist += self.problem.dist[self.path[j-1]][self.path[j]]
-
-        if __debug__:
-            dist = sum(map(lambda t: self.problem.dist[t[0]][t[1]],
-                           pairwise(self.path)))
+        i, j = lmove
+        self.dist -= self.problem.dist[self.path[i-1], self.path[i]]
+        self.dist -= self.problem.dist[self.path[j-1], self.path[j]]
+        self.path[i:j] = self.path[i:j][::-1]
+        self.dist += self.problem.dist[self.path[i-1], self.path[i]]
+        self.dist += self.problem.dist[self.path[j-1], self.path[j]]
+
+        if _DEEP_CHECKS:
+            path = self.path[:self.plen]
+            dist = float(self.problem.dist[path[:-1], path[1:]].sum())
             assert isclose(dist, self.dist), (dist, self.dist)
-            assert self.path[0] == self.start, self.path
-            assert self.path[-1] == self.start, self.path
+            assert path[0] == self.start, path
+            assert path[-1] == self.start, path
 
     def objective_incr_local(self, lmove: LocalMove) -> Optional[float]:
-        i, j = lmove.i, lmove.j
+        i, j = lmove
         ndist = self.dist
-        ndist -= self.problem.dist[self.path[i-1]][self.path[i]]
-        ndist -= self.problem.dist[self.path[j-1]][self.path[j]]
-        ndist += self.problem.dist[self.path[i-1]][self.path[j-1]]
-        ndist += self.problem.dist[self.path[i]][self.path[j]]
+        ndist -= self.problem.dist[self.path[i-1], self.path[i]]
+        ndist -= self.problem.dist[self.path[j-1], self.path[j]]
+        ndist += self.problem.dist[self.path[i-1], self.path[j-1]]
+        ndist += self.problem.dist[self.path[i], self.path[j]]
         return ndist - self.dist
 
     def lower_bound_incr_add(self, component: Component) -> Optional[float]:
-        if len(self.path) + 1 <= cast(Problem, self.problem).nnodes:
+        if self.plen + 1 <= cast(Problem, self.problem).nnodes:
             u, v = component.u, component.v
-            d = self.problem.dist[u][v]
+            d = self.problem.dist[u, v]
             return d
         else:
             return 0
@@ -182,41 +194,41 @@ class Solution():
                 self.step(move)
 
     def components(self) -> Iterable[Component]:
-        for i in range(1, len(self.path)):
-            yield Component(self.path[i-1], self.path[i])
+        path = self.path[:self.plen].tolist()
+        for i in range(1, len(path)):
+            yield Component(path[i-1], path[i])
 
 @dataclass
 class Point:
+    __slots__ = ('x', 'y')
     x: float
     y: float
 
 if sys.version_info < (3, 9):
     CoordList = Sequence
-    DistMatrix = tuple
 else:
     CoordList = Sequence[Point]
-    DistMatrix = tuple[tuple[float, ...], ...]
-
-def euclidean_dist(a: Point, b: Point) -> float:
-    dx = a.x - b.x
-    dy = a.y - b.y
-    return sqrt(dx*dx + dy*dy)
+DistMatrix = np.ndarray
 
 def distance_matrix(coords: CoordList) -> DistMatrix:
-    mat = []
-    for a in coords:
-        row = []
-        for b in coords:
-            row.append(euclidean_dist(a, b))
-        mat.append(tuple(row))
-    return tuple(mat)
+    X = np.asarray([(p.x, p.y) for p in coords], dtype=np.float64).reshape(-1, 2)
+    diff = X[:, None, :] - X[None, :, :]
+    return np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
 
 class Problem():
     def __init__(self, coords: CoordList) -> None:
         self.nnodes = len(coords)
         self.coords = coords
         self.dist = distance_matrix(coords)
-        
+        self._local_move_pairs: dict[int, tuple[np.ndarray, np.ndarray]] = {}
+
+    def local_move_pairs(self, plen: int) -> tuple[np.ndarray, np.ndarray]:
+        "All 2-opt moves (i, j), 1 <= i, i+2 <= j < plen, as two index arrays"
+        if plen not in self._local_move_pairs:
+            ii, jj = np.triu_indices(max(plen-1, 0), k=2)
+            self._local_move_pairs[plen] = (ii + 1, jj + 1)
+        return self._local_move_pairs[plen]
+
     @classmethod
     def from_textio(cls, f: TextIO) -> Problem:
         n = int(f.readline())
@@ -227,10 +239,14 @@ class Problem():
         return cls(coords)
 
     def empty_solution(self) -> Solution:
-        return Solution(self, 0, [0], {0}, set(range(1, self.nnodes)), 0)
+        return self.empty_solution_with_start(0)
 
     def empty_solution_with_start(self, start: int) -> Solution:
-        return Solution(self, start, [start], {start}, set(range(self.nnodes))-{start}, 0)
+        path = np.empty(self.nnodes+1, dtype=np.int64)
+        path[0] = start
+        used = np.zeros(self.nnodes, dtype=np.bool_)
+        used[start] = True
+        return Solution(self, start, Path(path), 1, Used(used), 0)
 
 
 if __name__ == '__main__':